@@ -2,14 +2,18 @@
 import os
 from dotenv import load_dotenv  # Add this
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
-import json
 import time
+import atexit
 import logging
+from collections import OrderedDict, deque
 from typing import Dict, Tuple, List, Optional
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+import orjson
 import psycopg2
-from psycopg2.extras import Json
-from flask import Flask, request, jsonify, make_response
+from psycopg2.extras import Json, execute_batch
+from psycopg2.pool import ThreadedConnectionPool
+from flask import Flask, Response, request, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import threading
 from flask_cors import cross_origin
@@ -19,9 +23,12 @@ from helpers import (
     search_laws,
     build_html_answer,
     call_llm,
+    call_llm_stream,
     web_enrich_official_sources,
+    web_enrich_enabled,
     sanitize_html,  # <-- добавили
     load_jsonl,  # <-- добавили
+    question_cache_key,
 )
 
 
@@ -30,128 +37,367 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s - %(levelname)s - %(message)s")
 log = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson: request.get_json()/jsonify без stdlib json."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# тело запроса — только вопрос; большие тела отсекаем до чтения в память
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(64 * 1024)))
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY_BYTES
 
 # Убедитесь что пути совпадают с фронтендом
 LAWS_PATH = os.path.join(os.path.dirname(__file__), "laws", "normalized.jsonl")
 
 def check_files():
     if not os.path.exists(LAWS_PATH):
-        log.error(f"❌ Файл normalized.jsonl не найден по пути: {LAWS_PATH}")
+        log.error("❌ Файл normalized.jsonl не найден по пути: %s", LAWS_PATH)
     else:
-        log.info(f"✅ Файл normalized.jsonl найден, размер: {os.path.getsize(LAWS_PATH)/1024:.1f} KB")
+        log.info("✅ Файл normalized.jsonl найден, размер: %.1f KB", os.path.getsize(LAWS_PATH) / 1024)
 
 # Call the function directly after app creation
 check_files()
 
-# CORS configuration
-allowed_origins = [
-    "https://teg-ai-lawyer.netlify.app",
-    "http://127.0.0.1:5500",
-    "http://localhost:5500"
-]
+# CORS configuration (CORS_ORIGINS — список через запятую, переопределяет дефолт)
+_DEFAULT_ORIGINS = "https://teg-ai-lawyer.netlify.app,http://127.0.0.1:5500,http://localhost:5500"
+ALLOWED_ORIGINS = frozenset(
+    o.strip() for o in os.getenv("CORS_ORIGINS", _DEFAULT_ORIGINS).split(",") if o.strip()
+)
+# в development — отдельный wildcard-режим вместо "*" в общем списке origins
+allowed_origins = "*" if os.getenv("FLASK_ENV") == "development" else sorted(ALLOWED_ORIGINS)
 
-if os.getenv("FLASK_ENV") == "development":
-    allowed_origins.append("*")
+CORS_MAX_AGE = int(os.getenv("CORS_MAX_AGE", "86400"))  # браузер кэширует preflight
 
 CORS(app, 
      origins=allowed_origins, 
      supports_credentials=True,
      allow_headers=["Content-Type", "Authorization"],
-     methods=["GET", "POST", "OPTIONS"])
+     methods=["GET", "POST", "OPTIONS"],
+     max_age=CORS_MAX_AGE)
+
+log.info("✅ CORS включён для: %s", allowed_origins)
+
+# Origins, которым открыты /api/ask*: заданный CORS_ORIGINS действует и здесь;
+# по умолчанию cross_origin на роутах сужает общий список до прод-фронтенда
+API_ORIGINS = tuple(sorted(ALLOWED_ORIGINS)) if os.getenv("CORS_ORIGINS") else ("https://teg-ai-lawyer.netlify.app",)
+_API_ORIGINS_SET = frozenset(API_ORIGINS)
+
+# Заголовки preflight не зависят от запроса (кроме Origin) — собираем один раз
+_PREFLIGHT_HEADERS = (
+    ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+    ("Access-Control-Allow-Headers", "Content-Type, Authorization"),
+    ("Access-Control-Max-Age", str(CORS_MAX_AGE)),
+    ("Vary", "Origin"),
+)
+
+@app.before_request
+def _cors_preflight():
+    """Preflight (OPTIONS + Access-Control-Request-Method) к API отвечаем сразу, без view и flask-cors."""
+    if request.method != "OPTIONS" or "Access-Control-Request-Method" not in request.headers:
+        return None
+    origin = request.headers.get("Origin")
+    if origin not in _API_ORIGINS_SET or not request.path.startswith("/api/"):
+        return None  # остальное — обычная обработка flask-cors
+    resp = Response(status=204, headers=_PREFLIGHT_HEADERS)
+    resp.headers["Access-Control-Allow-Origin"] = origin
+    return resp
+
+# Параметры LLM
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "4"))
+# по потоку на каждый разрешённый лимитером вызов LLM + один под фоновую сборку индекса:
+# меньше — и вызовы сверх пула молча встают в очередь executor'а
+_executor = ThreadPoolExecutor(max_workers=max(1, LLM_MAX_INFLIGHT) + 1)
+LLM_TIMEOUT_SEC = int(os.getenv("LLM_TIMEOUT_SEC", "28"))  # короткий таймаут против 504
+# веб-поиск — в своём пуле: в общем _executor он встаёт в очередь за вызовами LLM (до 28с)
+# и под нагрузкой гарантированно не успевает в WEB_ENRICH_WAIT_SEC
+_web_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="web")
+# сколько ждать веб-обогащение после локального поиска; опоздавшие источники не ждём
+WEB_ENRICH_WAIT_SEC = float(os.getenv("WEB_ENRICH_WAIT_SEC", "2"))
 
-log.info(f"✅ CORS включён для: {allowed_origins}")
+class LLMLimiter:
+    """
+    Адаптивный лимит одновременных вызовов LLM (AIMD по EWMA латентности).
 
-# Lazy loading для индекса законов
-class LazyIndex:
-    def __init__(self):
-        self._docs = None
-        self._index = None
+    Сверх лимита вызов не ставится в очередь executor'а: сразу отдаём rule-based
+    fallback, а не ждём LLM_TIMEOUT_SEC за чужими медленными запросами.
+    """
+
+    def __init__(self, max_limit: int, slo_sec: float, alpha: float = 0.2):
         self._lock = threading.Lock()
-        self._initialized = False
-        self._error = None
-    
-    def _init_index(self):
-        """Инициализация индекса при первом обращении"""
-        if self._initialized:
-            return
-        
+        self._max = float(max(1, max_limit))
+        self._limit = self._max
+        self._inflight = 0
+        self._slo = slo_sec
+        self._alpha = alpha
+        self._ewma: Optional[float] = None
+
+    def try_acquire(self) -> bool:
         with self._lock:
-            if self._initialized:  # Double-check locking
+            if self._inflight >= int(self._limit):
+                return False
+            self._inflight += 1
+            return True
+
+    def cancel(self) -> None:
+        """Вернуть слот из try_acquire без замера латентности — вызов так и не состоялся."""
+        with self._lock:
+            self._inflight -= 1
+
+    def release(self, elapsed: float, ok: bool = True) -> None:
+        with self._lock:
+            self._inflight -= 1
+            if self._ewma is None:
+                self._ewma = elapsed
+            else:
+                self._ewma = self._alpha * elapsed + (1 - self._alpha) * self._ewma
+            if not ok or self._ewma > self._slo:
+                self._limit = max(1.0, self._limit / 2)  # мультипликативное уменьшение
+            else:
+                self._limit = min(self._max, self._limit + 1.0 / self._limit)  # аддитивный рост
+
+LLM_LIMITER = LLMLimiter(
+    max_limit=LLM_MAX_INFLIGHT,
+    slo_sec=float(os.getenv("LLM_SLO_SEC", "15")),
+)
+
+class CircuitBreaker:
+    """
+    Автомат для LLM: после threshold неудач подряд (ошибка, пустой ответ, таймаут)
+    на cooldown_sec вызовы не делаем — сразу fallback, потоки не ждут лежащего
+    провайдера по LLM_TIMEOUT_SEC. По истечении паузы пропускаем один пробный вызов.
+    """
+
+    def __init__(self, threshold: int, cooldown_sec: float):
+        self._lock = threading.Lock()
+        self._threshold = max(1, threshold)
+        self._cooldown = cooldown_sec
+        self._fails = 0
+        self._open_until = 0.0
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.time()
+            if now < self._open_until:
+                return False
+            if self._fails >= self._threshold:
+                # полуоткрыт: пропускаем пробный вызов, остальные ждут его исхода
+                self._open_until = now + self._cooldown
+            return True
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                if self._fails >= self._threshold:
+                    log.info("🔌 LLM снова отвечает — автомат замкнут")
+                self._fails = 0
+                self._open_until = 0.0
                 return
-            
-            try:
-                log.info("🔄 Инициализация индекса законов...")
-                self._docs, self._index = init_index()
-                self._initialized = True
-                log.info("✅ Индекс готов: %d фрагментов", len(self._docs))
-            except Exception as e:
-                log.exception("Index init failed")
-                self._error = e
-                log.error("❌ Ошибка инициализации индекса: %s", e)
-                raise
-    
-    @property
-    def docs(self):
-        if not self._initialized:
-            self._init_index()
-        if self._error:
-            raise self._error
-        return self._docs
-    
-    @property
-    def index(self):
-        if not self._initialized:
-            self._init_index()
-        if self._error:
-            raise self._error
-        return self._index
-    
-    def is_ready(self) -> bool:
-        """Проверка готовности индекса"""
-        return self._initialized and self._error is None
+            self._fails += 1
+            if self._fails >= self._threshold:
+                self._open_until = time.time() + self._cooldown
+                if self._fails == self._threshold:
+                    log.warning("🔌 LLM: %d неудач подряд — автомат разомкнут на %.0fс", self._fails, self._cooldown)
+
+LLM_BREAKER = CircuitBreaker(
+    threshold=int(os.getenv("LLM_BREAKER_FAILS", "5")),
+    cooldown_sec=float(os.getenv("LLM_BREAKER_COOLDOWN_SEC", "30")),
+)
 
-# Глобальный экземпляр lazy index
-LAZY_INDEX = LazyIndex()
-LAZY_INDEX._init_index()  # Принудительная инициализация при старте
+# Индекс законов строится один раз в фоне при старте; запросы берут готовый результат
+def _build_index():
+    log.info("🔄 Инициализация индекса законов...")
+    try:
+        docs, index = init_index()
+    except Exception as e:
+        log.exception("Index init failed")
+        log.error("❌ Ошибка инициализации индекса: %s", e)
+        raise
+    log.info("✅ Индекс готов: %d фрагментов", len(docs))
+    return docs, index
+
+_INDEX_FUT = _executor.submit(_build_index)
+_INDEX = None
+
+def get_index():
+    """(docs, index); до готовности блокирует, ошибку построения пробрасывает."""
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = _INDEX_FUT.result()
+    return _INDEX
+
+def index_ready() -> bool:
+    """Проверка готовности индекса (без блокировки)"""
+    return _INDEX_FUT.done() and _INDEX_FUT.exception() is None
+
+def index_failed() -> bool:
+    """Сборка индекса упала — сам он уже не появится, воркер нужно перезапустить."""
+    return _INDEX_FUT.done() and _INDEX_FUT.exception() is not None
+
+# Кэш готовых ответов: повторный/переформулированный вопрос не гоняем через LLM
+class AnswerCache:
+    """Потокобезопасный LRU с TTL; значения — тела ответов /api/ask без took_ms."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._data: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self._ttl = ttl
+
+    def get(self, key: str) -> Optional[Dict]:
+        if not key or self._maxsize <= 0:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            ts, value = item
+            if time.time() - ts > self._ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Dict) -> None:
+        if not key or self._maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+ANSWER_CACHE = AnswerCache(
+    maxsize=int(os.getenv("ANSWER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL_SEC", "3600")),
+)
+# для отладки: видно в DevTools/curl, пришёл ли ответ из ANSWER_CACHE
+_X_CACHE_HIT = {"X-Cache": "HIT"}
+_X_CACHE_MISS = {"X-Cache": "MISS"}
 
 # Database setup
 DB_DSN = os.getenv("DATABASE_URL")
-DB = None
+DB_POOL = None
 if DB_DSN:
     try:
-        DB = psycopg2.connect(DB_DSN)
-        with DB, DB.cursor() as cur:
-            cur.execute("""
-            create table if not exists qa_logs (
-              id bigserial primary key,
-              ts timestamptz default now(),
-              question text not null,
-              answer_html text not null,
-              intent text,
-              matches jsonb
-            )
-            """)
+        # пул вместо одного соединения на все потоки: _log_qa не ждут друг друга
+        DB_POOL = ThreadedConnectionPool(1, int(os.getenv("DB_POOL_MAX", "8")), DB_DSN)
+        conn = DB_POOL.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("""
+                create table if not exists qa_logs (
+                  id bigserial primary key,
+                  ts timestamptz default now(),
+                  question text not null,
+                  answer_html text not null,
+                  intent text,
+                  matches jsonb
+                )
+                """)
+        finally:
+            DB_POOL.putconn(conn)
         log.info("✅ DB logging enabled")
     except Exception as e:
         log.warning("DB connect failed: %s", e)
-        DB = None
+        DB_POOL = None
 
-def _log_qa(question: str, answer_html: str, intent: str, matches: List[Dict]):
-    if not DB:
-        return
+def _orjson_dumps_str(obj) -> str:
+    return orjson.dumps(obj).decode("utf-8")
+
+_QA_INSERT = "insert into qa_logs(question, answer_html, intent, matches) values (%s, %s, %s, %s)"
+
+def _write_qa_rows(rows: List[Tuple]) -> None:
+    """Пишем пачку строк qa_logs одной транзакцией (execute_batch — меньше round-trip'ов)."""
     try:
-        with DB, DB.cursor() as cur:
-            cur.execute(
-                "insert into qa_logs(question, answer_html, intent, matches) values (%s, %s, %s, %s)",
-                (question, answer_html, intent, Json(matches))
-            )
+        conn = DB_POOL.getconn()
     except Exception as e:
         log.warning("DB log failed: %s", e)
+        return
+    broken = False
+    try:
+        with conn, conn.cursor() as cur:
+            execute_batch(cur, _QA_INSERT, rows, page_size=QA_LOG_BATCH)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        # соединение умерло (рестарт БД, idle timeout) — выбрасываем его из пула
+        broken = True
+        log.warning("DB log failed (%d строк): %s", len(rows), e)
+    except Exception as e:
+        log.warning("DB log failed (%d строк): %s", len(rows), e)
+    finally:
+        DB_POOL.putconn(conn, close=broken or conn.closed != 0)
+
+class QALogWriter:
+    """
+    Фоновая пакетная запись qa_logs: запрос только кладёт строку в очередь,
+    поток сбрасывает накопленное раз в flush_sec или при batch_size строк.
+    Пока БД недоступна, очередь ограничена max_pending — старые строки вытесняются.
+    """
+
+    def __init__(self, flush_sec: float, batch_size: int, max_pending: int):
+        self._rows: deque = deque(maxlen=max_pending)
+        self._cond = threading.Condition()
+        self._flush_sec = flush_sec
+        self._batch_size = batch_size
+        self._thread: Optional[threading.Thread] = None
+
+    def push(self, row: Tuple) -> None:
+        with self._cond:
+            if self._thread is None:
+                # поток стартуем лениво — уже в процессе воркера, а не до fork
+                self._thread = threading.Thread(target=self._run, name="qa-log", daemon=True)
+                self._thread.start()
+            self._rows.append(row)
+            if len(self._rows) >= self._batch_size:
+                self._cond.notify()
+
+    def _take(self) -> List[Tuple]:
+        batch = []
+        while self._rows and len(batch) < self._batch_size:
+            batch.append(self._rows.popleft())
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if len(self._rows) < self._batch_size:
+                    self._cond.wait(timeout=self._flush_sec)
+                batch = self._take()
+            if batch:
+                _write_qa_rows(batch)
+
+    def flush(self) -> None:
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            _write_qa_rows(batch)
 
-# Параметры LLM
-_executor = ThreadPoolExecutor(max_workers=4)
-LLM_TIMEOUT_SEC = int(os.getenv("LLM_TIMEOUT_SEC", "28"))  # короткий таймаут против 504
+QA_LOG_BATCH = int(os.getenv("QA_LOG_BATCH", "200"))
+QA_LOG = QALogWriter(
+    flush_sec=float(os.getenv("QA_LOG_FLUSH_SEC", "0.5")),
+    batch_size=QA_LOG_BATCH,
+    max_pending=int(os.getenv("QA_LOG_MAX_PENDING", "10000")),
+)
+if DB_POOL:
+    atexit.register(QA_LOG.flush)  # при остановке воркера дописываем хвост очереди
+
+def _log_qa(question: str, answer_html: str, intent, matches: List[Dict]) -> None:
+    """Ставит Q&A в очередь на запись в БД; запрос не ждёт Postgres."""
+    if not DB_POOL:
+        return
+    intent_type = intent.get("type") if isinstance(intent, dict) else intent
+    QA_LOG.push((question, answer_html, intent_type, Json(matches, dumps=_orjson_dumps_str)))
 
 SYSTEM_PROMPT = """
 Ты — ИИ-юрист по законодательству Республики Казахстан. Формат ответа — строго HTML (p, ul/li, strong, h3, br). 
@@ -174,152 +420,386 @@ SYSTEM_PROMPT = """
 
 def _preview_bytes(b: bytes, limit: int = 500) -> str:
     try:
-        t = b.decode("utf-8", errors="replace")
+        # декодируем только начало: символ UTF-8 — не больше 4 байт, тело может быть до MAX_BODY_BYTES
+        t = b[:limit * 4].decode("utf-8", errors="replace")
     except Exception:
         return f"<{len(b)} bytes, decode failed>"
     t = t.strip().replace("\n", "\\n")
-    return (t[:limit] + ("…" if len(t) > limit else "")) or "<empty>"
+    return (t[:limit] + ("…" if len(t) > limit or len(b) > limit * 4 else "")) or "<empty>"
 
 def get_json_payload() -> Tuple[Dict, Dict]:
-    headers = {k.lower(): v for k, v in request.headers.items()}
-    ctype = headers.get("content-type", "")
+    ctype = request.content_type or ""
     raw = request.get_data()
-    dbg = {"content_type": ctype, "body_preview": _preview_bytes(raw), "json_error": None}
+    # body_preview нужен только в ответе-ошибке — заполняется в _read_question
+    dbg = {"content_type": ctype, "body_preview": None, "json_error": None}
     payload = {}
     if raw:
         try:
-            decoded = raw.decode("utf-8", errors="replace")
-            log.info(f"📥 Декодированный запрос: {decoded}")  # Log raw decoded data
-            payload = json.loads(decoded)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("📥 Декодированный запрос: %s", raw.decode("utf-8", errors="replace"))
+            payload = orjson.loads(raw)  # orjson принимает bytes — без промежуточного str
             if not isinstance(payload, dict):
-                log.error(f"❌ Payload не является словарем: {payload}")
+                log.error("❌ Payload не является словарем: %s", payload)
                 dbg["json_error"] = "Payload is not a dictionary"
                 payload = {}
         except Exception as e:
-            log.error(f"❌ Ошибка парсинга JSON: {str(e)}")
+            log.error("❌ Ошибка парсинга JSON: %s", e)
             dbg["json_error"] = str(e)
     return payload, dbg
 
+def json_response(obj, status: int = 200, headers: Optional[Dict] = None) -> Response:
+    """JSON-ответ через orjson (быстрее stdlib json, сразу отдаёт UTF-8 bytes)."""
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json", headers=headers)
+
 def json_error(status: int, code: str, message: str, debug: Dict = None):
     body = {"ok": False, "error": {"code": code, "message": message}}
     if debug:
         body["debug"] = debug
-    resp = make_response(jsonify(body), status)
-    resp.headers["Content-Type"] = "application/json; charset=utf-8"
-    return resp
+    return json_response(body, status)
+
+def _health_body() -> Dict:
+    ready = index_ready()
+    return {
+        "ok": ready,
+        "laws_count": len(get_index()[0]) if ready else 0,
+        "index_ready": ready,
+        "llm": bool(os.getenv("GEMINI_API_KEY")),
+        "message": "ready" if ready else ("index build failed" if index_failed() else "initializing")
+    }
+
+# После готовности индекса тело health больше не меняется — сериализуем его один раз.
+# Готовый Response не переиспользуем: flask-cors дописывает заголовки в объект ответа.
+_HEALTH_READY_BYTES: Optional[bytes] = None
+_HEALTH_READY_HEADERS = {"Cache-Control": "public, max-age=1"}
+_HEALTH_INIT_HEADERS = {"Cache-Control": "no-store"}  # «initializing» кэшировать нельзя
+
+def _health_response(not_ready_status: int) -> Response:
+    global _HEALTH_READY_BYTES
+    if _HEALTH_READY_BYTES is None:
+        body = _health_body()
+        if not body["index_ready"]:
+            # индекс не собрался — 500 и на liveness: оркестратор перезапустит воркер
+            status = 500 if index_failed() else not_ready_status
+            return Response(orjson.dumps(body), status=status,
+                            mimetype="application/json", headers=_HEALTH_INIT_HEADERS)
+        _HEALTH_READY_BYTES = orjson.dumps(body)
+    return Response(_HEALTH_READY_BYTES, mimetype="application/json", headers=_HEALTH_READY_HEADERS)
 
 @app.route("/health", methods=["GET"])
-@app.route("/api/health", methods=["GET"])
 def health():
-    start_time = time.time()
-    timeout = 30  # сек
-    while not LAZY_INDEX.is_ready() and (time.time() - start_time) < timeout:
-        time.sleep(1)
-    
-    llm_ready = bool(os.getenv("GEMINI_API_KEY"))
-    index_ready = LAZY_INDEX.is_ready()
-    laws_count = len(LAZY_INDEX.docs) if index_ready else 0
-    
-    return jsonify({
-        "ok": index_ready,
-        "laws_count": laws_count,
-        "index_ready": index_ready,
-        "llm": llm_ready,
-        "message": "ready" if index_ready else "initializing"
-    })
+    """Liveness: 200 сразу, индекс не ждём (статус — в теле); 500, если его сборка упала."""
+    return _health_response(200)
 
-def _handle_ask():
-    started = time.time()
+@app.route("/api/health", methods=["GET"])
+def readiness():
+    """Readiness: 503, пока индекс строится — балансировщик/оркестратор повторит сам."""
+    return _health_response(503)
+
+def _matches_payload(hits) -> List[Dict]:
+    return [
+        {
+            "article_title": r.get("article_title"),
+            "law_title": r.get("law_title"),
+            "source": r.get("source"),
+            "score": s
+        }
+        for r, s in hits
+    ]
+
+def _read_question():
+    """Разбор тела запроса: (question, None) или (None, ответ-ошибка)."""
+    # chunked-тело без Content-Length Werkzeug молча обрезает по MAX_CONTENT_LENGTH —
+    # упёршееся в лимит тело — это 413, а не битый JSON; с Content-Length ровно
+    # в лимит тело целое, его не трогаем
+    declared = request.content_length
+    if declared is not None:
+        too_large = declared > MAX_BODY_BYTES
+    else:
+        too_large = len(request.get_data()) >= MAX_BODY_BYTES
+    if too_large:
+        return None, json_error(413, "PAYLOAD_TOO_LARGE", f"Тело запроса больше {MAX_BODY_BYTES} байт.")
     payload, dbg = get_json_payload()
     question = (payload.get("question") or "").strip()
     if not question:
-        return json_error(400, "MISSING_FIELD", "Поле 'question' обязательно и не должно быть пустым.", dbg)
-
-    log.info("👤 Вопрос: %s", question)
-
+        dbg["body_preview"] = _preview_bytes(request.get_data())  # тело уже прочитано и закэшировано
+        return None, json_error(400, "MISSING_FIELD", "Поле 'question' обязательно и не должно быть пустым.", dbg)
+
+    log.info("👤 Вопрос: %d симв.", len(question))
+    log.debug("👤 Вопрос: %s", question)
+    return question, None
+
+def _prepare_ask(question: str):
+    """
+    Общая часть /api/ask и /api/ask/stream: поиск по базе и веб-обогащение.
+    Возвращает ((hits, intent, web_sources), None) или (None, ответ-ошибка).
+    """
     # Проверяем готовность индекса
-    if not LAZY_INDEX.is_ready():
-        return json_error(503, "INDEX_NOT_READY", "Индекс законов ещё не готов. Попробуйте через несколько секунд.")
+    if index_failed():
+        return None, json_error(500, "INDEX_FAILED", "Индекс законов не удалось загрузить. Сервис будет перезапущен.")
+    if not index_ready():
+        return None, json_error(503, "INDEX_NOT_READY", "Индекс законов ещё не готов. Попробуйте через несколько секунд.")
+
+    # Веб-обогащение (если заданы ключи) — сетевой запрос идёт параллельно с локальным поиском
+    web_fut = _web_executor.submit(web_enrich_official_sources, question, limit=3) if web_enrich_enabled() else None
 
-    hits, intent = search_laws(question, LAZY_INDEX.docs, LAZY_INDEX.index, top_k=5)
+    docs, index = get_index()
+    hits, intent = search_laws(question, docs, index, top_k=5)
     log.info("🔎 Совпадений: %d | intent: %s", len(hits), intent['type'])
 
-    # Веб-обогащение (если заданы ключи)
     web_sources: List[Dict] = []
+    if web_fut is None:
+        return (hits, intent, web_sources), None
     try:
-        web_sources = web_enrich_official_sources(question, limit=3)
+        web_sources = web_fut.result(timeout=WEB_ENRICH_WAIT_SEC)
         if web_sources:
             log.info("🌐 Веб-источники: %d", len(web_sources))
+    except TimeoutError:
+        log.warning("🌐 Веб-обогащение не успело за %.1fс — отвечаем без него", WEB_ENRICH_WAIT_SEC)
     except Exception as e:
         log.warning("web_enrich_official_sources failed: %s", e)
 
-    # LLM с таймаутом
-    llm_html = ""
-    try:
-        fut = _executor.submit(call_llm, question, hits, intent, web_sources)
-        llm_html = fut.result(timeout=LLM_TIMEOUT_SEC) or ""
-    except TimeoutError:
-        log.error("⏳ LLM timeout (%ss) — отдаём rule-based fallback", LLM_TIMEOUT_SEC)
-    except Exception as e:
-        log.exception("LLM fail: %s", e)
+    return (hits, intent, web_sources), None
 
-    # Финальная сборка + санитайзер
-    answer_html = (llm_html.strip() or build_html_answer(question, hits, intent)).strip()
-    answer_html = sanitize_html(answer_html)  # <-- главное исправление
+def _cached_answer(question: str, started: float) -> Optional[Dict]:
+    cached = ANSWER_CACHE.get(question_cache_key(question))
+    if cached is None:
+        return None
+    took = int((time.time() - started) * 1000)
+    log.info("♻️ Ответ из кэша (%d симв) за %d мс", len(cached["answer_html"]), took)
+    _log_qa(question, cached["answer_html"], cached["intent"], cached["matches"])
+    return {**cached, "took_ms": took}
+
+def _finalize_answer(question: str, llm_html: str, hits, intent, started: float,
+                     cacheable: bool = True) -> Dict:
+    """Финальная сборка + санитайзер, лог в БД; возвращает тело ответа."""
+    llm_html = llm_html.strip()
+    if llm_html:
+        answer_html = sanitize_html(llm_html)  # <-- главное исправление: ответ модели не доверенный
+    else:
+        # rule-based ответ уже прошёл санитайзер внутри build_html_answer — второй раз не парсим
+        answer_html = build_html_answer(question, hits, intent).strip()
     took = int((time.time() - started) * 1000)
     log.info("✅ Ответ готов (%d симв) за %d мс", len(answer_html), took)
 
-    _log_qa(question, answer_html, intent, [
-        {
-            "article_title": r.get("article_title"),
-            "law_title": r.get("law_title"),
-            "source": r.get("source"),
-            "score": s
-        }
-        for r, s in hits
-    ])
+    matches = _matches_payload(hits)
+    _log_qa(question, answer_html, intent, matches)
 
-    return jsonify({
+    body = {
         "ok": True,
         "answer_html": answer_html,
-        "matches": [
-            {
-                "article_title": r.get("article_title"),
-                "law_title": r.get("law_title"),
-                "source": r.get("source"),
-                "score": s
-            }
-            for r, s in hits
-        ],
+        "matches": matches,
         "intent": intent,
-        "took_ms": took
-    })
+    }
+    # rule-based fallback и оборванный ответ не кэшируем — в следующий раз LLM может ответить
+    if cacheable and llm_html:
+        ANSWER_CACHE.put(question_cache_key(question), body)
+    return {**body, "took_ms": took}
+
+# Одинаковые вопросы, пришедшие одновременно, склеиваем в один вызов LLM
+_LLM_CALLS: Dict[str, Future] = {}
+_LLM_CALLS_LOCK = threading.Lock()
+
+def _submit_llm(question: str, hits, intent, web_sources) -> Optional[Future]:
+    """
+    Future с HTML ответа модели; None — LLM сейчас не вызываем (нужен fallback).
+    Если такой же вопрос (тот же ключ кэша) уже у модели — возвращаем его future.
+    """
+    key = question_cache_key(question)
+    with _LLM_CALLS_LOCK:
+        fut = _LLM_CALLS.get(key) if key else None
+        if fut is not None:
+            log.info("🔗 Такой же вопрос уже у LLM — ждём общий ответ")
+            return fut
+        # сначала слот лимитера: allow() в полуоткрытом состоянии расходует пробный вызов,
+        # и отказ лимитера после него держал бы автомат разомкнутым ещё целую паузу
+        if not LLM_LIMITER.try_acquire():
+            log.warning("🚦 LLM перегружен — отдаём rule-based fallback")
+            return None
+        if not LLM_BREAKER.allow():
+            LLM_LIMITER.cancel()
+            log.warning("🔌 Автомат LLM разомкнут — отдаём rule-based fallback")
+            return None
+        llm_started = time.time()
+        # дедлайн — и в самом SDK: иначе по таймауту ниже ждать перестаём, а вызов висит дальше
+        fut = _executor.submit(call_llm, question, hits, intent, web_sources, LLM_TIMEOUT_SEC)
+        if key:
+            _LLM_CALLS[key] = fut
+
+    def _done(f: Future) -> None:
+        if key:
+            with _LLM_CALLS_LOCK:
+                if _LLM_CALLS.get(key) is f:
+                    del _LLM_CALLS[key]
+        # слот освобождаем, когда вызов реально завершился (и после нашего таймаута тоже)
+        elapsed = time.time() - llm_started
+        # call_llm глотает ошибки и отдаёт "" — пустой ответ тоже неудача (и для лимита, и для автомата)
+        ok = f.exception() is None and bool(f.result())
+        LLM_LIMITER.release(elapsed, ok)
+        LLM_BREAKER.record(ok and elapsed <= LLM_TIMEOUT_SEC)
+
+    fut.add_done_callback(_done)
+    return fut
+
+def _handle_ask():
+    started = time.time()
+    question, err = _read_question()
+    if err is not None:
+        return err
+
+    cached = _cached_answer(question, started)
+    if cached is not None:
+        return json_response(cached, headers=_X_CACHE_HIT)
+
+    ctx, err = _prepare_ask(question)
+    if err is not None:
+        return err
+    hits, intent, web_sources = ctx
+
+    # LLM с таймаутом и адаптивным лимитом параллельных вызовов
+    llm_html = ""
+    fut = _submit_llm(question, hits, intent, web_sources)
+    if fut is not None:
+        try:
+            llm_html = fut.result(timeout=LLM_TIMEOUT_SEC) or ""
+        except TimeoutError:
+            log.error("⏳ LLM timeout (%ss) — отдаём rule-based fallback", LLM_TIMEOUT_SEC)
+        except Exception as e:
+            log.exception("LLM fail: %s", e)
+
+    return json_response(_finalize_answer(question, llm_html, hits, intent, started), headers=_X_CACHE_MISS)
+
+def _sse(data: Dict, event: Optional[str] = None) -> bytes:
+    """Один кадр Server-Sent Events с JSON в data."""
+    head = b"event: " + event.encode() + b"\n" if event else b""
+    return head + b"data: " + orjson.dumps(data) + b"\n\n"
+
+def _handle_ask_stream():
+    """
+    То же, что _handle_ask, но ответ модели уходит клиенту по мере генерации (SSE).
+
+    Кадры без event — {"delta": ...}: санитизированный HTML очередного законченного
+    блока, клиент дописывает его в сообщение. Последний кадр — event: done с тем же
+    телом, что у /api/ask (или event: error); его answer_html заменяет набранное.
+    """
+    started = time.time()
+    question, err = _read_question()
+    if err is not None:
+        return err
+
+    cached = _cached_answer(question, started)
+    if cached is not None:
+        body = _sse({"delta": cached["answer_html"]}) + _sse(cached, event="done")
+        return Response(body, mimetype="text/event-stream", headers={"Cache-Control": "no-cache", **_X_CACHE_HIT})
+
+    ctx, err = _prepare_ask(question)
+    if err is not None:
+        return err
+    hits, intent, web_sources = ctx
+
+    def _gen():
+        parts: List[str] = []
+        llm_html = ""
+        # исход вызова модели: True/False — ответила полностью/сбой или таймаут;
+        # None — до исхода не дошли (клиент закрыл соединение посреди ответа)
+        llm_ok: Optional[bool] = None
+        # порядок как в _submit_llm: слот лимитера до пробного вызова автомата
+        acquired = LLM_LIMITER.try_acquire()
+        if not acquired:
+            log.warning("🚦 LLM перегружен — отдаём rule-based fallback")
+        elif not LLM_BREAKER.allow():
+            LLM_LIMITER.cancel()
+            acquired = False
+            log.warning("🔌 Автомат LLM разомкнут — отдаём rule-based fallback")
+        llm_started = time.time()
+        try:
+            if acquired:
+                stream = call_llm_stream(question, hits, intent, web_sources, timeout=LLM_TIMEOUT_SEC)
+                try:
+                    while True:
+                        try:
+                            delta = next(stream)
+                        except StopIteration as stop:
+                            # HTML всего ответа одним проходом — как у /api/ask, а не склейка дельт
+                            llm_html = stop.value or ""
+                            llm_ok = bool(llm_html)
+                            break
+                        parts.append(delta)
+                        yield _sse({"delta": delta})
+                        if time.time() - started > LLM_TIMEOUT_SEC:
+                            log.error("⏳ LLM stream timeout (%ss) — обрываем генерацию", LLM_TIMEOUT_SEC)
+                            llm_ok = False
+                            break
+                except Exception as e:
+                    log.exception("LLM stream error: %s", e)
+                    llm_ok = False
+                finally:
+                    stream.close()
+            # оборванный ответ показываем как есть, но не кэшируем
+            if llm_ok is False:
+                llm_html = "".join(parts)
+            yield _sse(_finalize_answer(question, llm_html, hits, intent, started, cacheable=llm_ok is not False), event="done")
+        except Exception as e:
+            log.error("❌ Ошибка при стриминге ответа: %s", e, exc_info=True)
+            yield _sse({"ok": False, "error": {"code": "INTERNAL_ERROR", "message": str(e)}}, event="error")
+        finally:
+            if acquired:
+                if llm_ok is None:
+                    # клиент ушёл — о здоровье модели это ничего не говорит: слот возвращаем без замера
+                    LLM_LIMITER.cancel()
+                else:
+                    LLM_LIMITER.release(time.time() - llm_started, llm_ok)
+                    LLM_BREAKER.record(llm_ok)
+
+    return Response(
+        stream_with_context(_gen()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **_X_CACHE_MISS},
+    )
 
 #@cross_origin(origins=["http://127.0.0.1:5500", "http://localhost:5500"], supports_credentials=True)
 @app.route("/api/ask", methods=["POST", "OPTIONS"])
-@cross_origin(origins=["https://teg-ai-lawyer.netlify.app"])
+@cross_origin(origins=list(API_ORIGINS))
 def ask_question():
     if request.method == "OPTIONS":
         # Handle preflight request
         return ("", 204)
     
     try:
-        data = request.get_json(silent=True)
-        log.info(f"📥 Получен JSON payload: {data}")  # Log the payload
-        return _handle_ask()  # Delegate to _handle_ask
+        return _handle_ask()  # тело разбирается один раз — в get_json_payload
+    except Exception as e:
+        log.error("❌ Произошла непредвиденная ошибка: %s", e, exc_info=True)
+        return json_response({
+            "error": {
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
+            },
+            "ok": False
+        }, 500)
+
+@app.route("/api/ask/stream", methods=["POST", "OPTIONS"])
+@cross_origin(origins=list(API_ORIGINS))
+def ask_question_stream():
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    try:
+        return _handle_ask_stream()
     except Exception as e:
-        log.error(f"❌ Произошла непредвиденная ошибка: {str(e)}", exc_info=True)
-        return jsonify({
+        log.error("❌ Произошла непредвиденная ошибка: %s", e, exc_info=True)
+        return json_response({
             "error": {
                 "code": "INTERNAL_ERROR",
                 "message": str(e)
             },
             "ok": False
-        }), 500
+        }, 500)
+
+_ROOT_404_HEADERS = {"Cache-Control": "public, max-age=60"}
 
 @app.route("/", methods=["GET"])
 def root_404():
-    return make_response("Not Found", 404)
+    # корень API ничего не отдаёт; даём пробам и сканерам закэшировать 404
+    return Response(b"Not Found", status=404, headers=_ROOT_404_HEADERS)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
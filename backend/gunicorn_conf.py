@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Конфиг gunicorn для продакшена:
+
+    gunicorn -c gunicorn_conf.py app:app
+
+Воркеры gthread: вызовы Gemini/веб-поиска — сетевой I/O, потоки не держат CPU,
+а app.py уже опирается на потоки (ThreadPoolExecutor, locks). gevent не берём:
+grpc-клиент google-generativeai с monkey-patching не дружит.
+
+preload_app выключен намеренно: при импорте app.py стартуют фоновые потоки
+(сборка индекса, executor'ы) и открывается пул соединений к БД — после fork
+они в воркерах не живут / становятся общими сокетами. Индекс и корпус и так
+общие между воркерами: оба открываются через mmap (laws/normalized.index,
+normalized.jsonl) и лежат в page cache одной копией.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# WEB_CONCURRENCY — стандартная переменная PaaS; по умолчанию 2*CPU+1, но не больше 4:
+# у каждого воркера свой кэш ответов и лимит LLM, память контейнера ограничена
+workers = int(os.getenv("WEB_CONCURRENCY", min(2 * multiprocessing.cpu_count() + 1, 4)))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+preload_app = False
+
+# для gthread это таймаут «зависшего» воркера, а не запроса; держим с запасом над LLM_TIMEOUT_SEC,
+# чтобы поднятый таймаут LLM не обрывался убийством воркера
+timeout = int(os.getenv("GUNICORN_TIMEOUT", int(os.getenv("LLM_TIMEOUT_SEC", "28")) + 7))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
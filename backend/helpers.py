@@ -6,13 +6,22 @@ import re
 import json
 import logging
 import html
+import hashlib
 import time
-from typing import List, Dict, Tuple, Optional
+import mmap
+from collections import defaultdict
+from functools import lru_cache
+from typing import List, Dict, Tuple, Optional, Sequence, Generator
 
+import numpy as np
+import orjson
 import google.generativeai as genai
+from google.api_core import exceptions as gexc
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from rank_bm25 import BM25Okapi
 import requests  # опционально для web-обогащения
-import bleach
+from requests.adapters import HTTPAdapter
+import nh3
 
 log = logging.getLogger(__name__)
 
@@ -40,70 +49,91 @@ _ALLOWED_ATTRS = {
     "a": ["href", "target", "rel"]
 }
 
+# регэкспы для постобработки компилируем один раз — они гоняются на каждом ответе
+# у всех формулировок одна замена — одна альтернация вместо пяти проходов по тексту
+_FORBIDDEN_REFERRALS_RE = re.compile("|".join(f"(?:{rx})" for rx in FORBIDDEN_REFERRALS), re.I)
+_RE_DOC_SHELL = re.compile(r"</?(?:html|head|body)[^>]*>", re.I)
+_RE_BR_RUN = re.compile(r"(\s*<br\s*/?>\s*){3,}", re.I)
+_RE_NL_RUN = re.compile(r"\n{3,}")
+_RE_EMPTY_P = re.compile(r"<p>\s*(?:&nbsp;)?\s*</p>", re.I)
+_RE_WS_BEFORE_END = re.compile(r"\s+(</(?:li|p)>)")
+_RE_MD_BOLD = re.compile(r"\*\*(.+?)\*\*")
+_RE_BARE_NL = re.compile(r'(?<!&lt;)(?<!<)(?<!>)\n(?!&gt;)(?!>)')
+_RE_ESCAPED_TAG = re.compile(
+    r"&lt;(/?(?:p|strong|ul|li|h3|h4|pre|a|em|ol|blockquote|code|span|small)|br|hr)&gt;"
+)
+
 def enforce_rules(html: str) -> str:
     """Убираем «идите к юристу», чистим мусор, нормализуем отступы."""
     text = html
+    # регэкспы запускаем, только если в тексте вообще есть их якорь — `in` по строке
+    # в разы дешевле прохода regex-движка, а в типичном ответе якорей нет
+    low = text.lower()
 
     # 1) вырезаем любые намёки «идите к юристу»
-    for rx in FORBIDDEN_REFERRALS:
-        text = re.sub(rx, "я помогу подготовить всё здесь, в этом чате", text, flags=re.I)
+    if "юрист" in low:
+        text = _FORBIDDEN_REFERRALS_RE.sub("я помогу подготовить всё здесь, в этом чате", text)
 
     # 2) если вдруг LLM прислал оболочку <html>/<body> — просто выбрасываем её
-    text = re.sub(r"</?(?:html|head|body)[^>]*>", "", text, flags=re.I)
+    if "html" in low or "body" in low or "head" in low:
+        text = _RE_DOC_SHELL.sub("", text)
 
     # 3) убираем лишние пустые абзацы/переводы строк
-    text = re.sub(r"(\s*<br\s*/?>\s*){3,}", "<br>", text, flags=re.I)
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    if "<br" in low:
+        text = _RE_BR_RUN.sub("<br>", text)
+    if "\n\n\n" in text:
+        text = _RE_NL_RUN.sub("\n\n", text)
 
-    # 4) убрать пустые параграфы
-    text = re.sub(r"<p>\s*(?:&nbsp;)?\s*</p>", "", text, flags=re.I)
-    # сжать подряд идущие пустые параграфы
-    text = re.sub(r"(?:<p>\s*</p>){2,}", "", text, flags=re.I)
+    # 4) убрать пустые параграфы (и их серии — каждый матчится по отдельности)
+    text = _RE_EMPTY_P.sub("", text)
 
     return text.strip()
 
+# nh3 (ammonia, Rust) — компилируется один раз, потокобезопасен и не держит GIL-тяжёлый
+# html5lib-парсер на каждый вызов, как bleach. Незнакомые теги срезаются, текст остаётся;
+# содержимое <script>/<style> выбрасывается целиком.
+_HTML_CLEANER = nh3.Cleaner(
+    tags=set(_ALLOWED_TAGS),
+    attributes={tag: set(attrs) for tag, attrs in _ALLOWED_ATTRS.items()},
+    url_schemes={"http", "https", "mailto"},
+    link_rel=None,  # rel разрешён в _ALLOWED_ATTRS — не перезаписываем его
+)
+# аналог bleach.clean(s, strip=True) с дефолтным набором тегов bleach
+_TEXT_CLEANER = nh3.Cleaner(
+    tags={"a", "abbr", "acronym", "b", "blockquote", "code", "em", "i", "li", "ol", "strong", "ul"},
+    attributes={"a": {"href", "title"}, "abbr": {"title"}, "acronym": {"title"}},
+    url_schemes={"http", "https", "mailto"},
+    link_rel=None,
+)
+
 def sanitize_html(html: str) -> str:
-    return bleach.clean(
-        html,
-        tags=_ALLOWED_TAGS,
-        attributes=_ALLOWED_ATTRS,
-        strip=True
-    )
+    return _HTML_CLEANER.clean(html)
 
 def postprocess_html(html: str) -> str:
     """Последовательность: правила -> sanitize -> финальный легкий рефайн."""
     html = enforce_rules(html)
     html = sanitize_html(html)
     # финальная полировка пробелов
-    html = re.sub(r"\s+</li>", "</li>", html)
-    html = re.sub(r"\s+</p>", "</p>", html)
+    html = _RE_WS_BEFORE_END.sub(r"\1", html)
     return html
 
-def build_html_answer(question: str, hits, intent: dict) -> str:
-    """
-    Рендерим итоговый HTML-ответ. Тут же:
-    - не вставляем <html>/<body>;
-    - даём аккуратный «шаблон/структуру» без сырого HTML;
-    - добавляем явное пояснение к «Что уточнить».
-    """
-    # краткое введение (можешь подменить на своё)
-    intro = (
-        "<h3>Юридическая оценка</h3>"
-        "<p>Ниже я даю практические шаги и заготовки документов по вашему запросу. "
-        "Если потребуется — я уточню детали и помогу адаптировать формулировки здесь, без направлений к третьим лицам.</p>"
-    )
-
-    # «Что делать» всегда есть
-    steps = [
-        "Кратко зафиксируйте, что произошло и чего вы хотите добиться (результат).",
-        "Подготовьте и подайте документ по ситуации (заявление/претензия/исковое — подскажу ниже).",
-        "Соберите подтверждения: переписка, акты, фото/видео, свидетельские показания — всё храните копиями.",
-        "Отслеживайте сроки (на обжалование, уведомление и т.д.) — при необходимости напомню конкретные нормы.",
-    ]
-    steps_html = "<h3>Что делать пошагово</h3><ul>" + "".join(f"<li>{s}</li>" for s in steps) + "</ul>"
-
-    # аккуратный «шаблон»: структура, а не сырой HTML
-    template_html = """
+# Статичные части ответа собираем один раз при импорте, а не на каждый запрос
+_ANSWER_INTRO = (
+    "<h3>Юридическая оценка</h3>"
+    "<p>Ниже я даю практические шаги и заготовки документов по вашему запросу. "
+    "Если потребуется — я уточню детали и помогу адаптировать формулировки здесь, без направлений к третьим лицам.</p>"
+)
+
+# «Что делать» всегда есть
+_ANSWER_STEPS = (
+    "Кратко зафиксируйте, что произошло и чего вы хотите добиться (результат).",
+    "Подготовьте и подайте документ по ситуации (заявление/претензия/исковое — подскажу ниже).",
+    "Соберите подтверждения: переписка, акты, фото/видео, свидетельские показания — всё храните копиями.",
+    "Отслеживайте сроки (на обжалование, уведомление и т.д.) — при необходимости напомню конкретные нормы.",
+)
+
+# аккуратный «шаблон»: структура, а не сырой HTML
+_ANSWER_TEMPLATE = """
 <h3>Шаблоны/документы</h3>
 <p><strong>Быстрая структура документа (адаптируйте под вашу ситуацию):</strong></p>
 <ul>
@@ -117,13 +147,45 @@ def build_html_answer(question: str, hits, intent: dict) -> str:
 <p class="muted">Нужно — сгенерирую готовый текст прямо здесь по вашим исходным данным.</p>
 """.strip()
 
+_ANSWER_HEAD = (
+    _ANSWER_INTRO
+    + "<h3>Что делать пошагово</h3><ul>" + "".join(f"<li>{s}</li>" for s in _ANSWER_STEPS) + "</ul>"
+    + _ANSWER_TEMPLATE
+)
+
+# «Что уточнить» — с явным пояснением ЗАЧЕМ
+_CLARIFY_INTRO = (
+    "<h3>Что уточнить</h3>"
+    "<p class=\"muted\">Для качественного разъяснения вашей ситуации ответьте, пожалуйста, на несколько вопросов:</p>"
+)
+
+# базовый набор, если модель не прислала свои (тексты доверенные — без очистки)
+_DEFAULT_CLARIFY_HTML = _CLARIFY_INTRO + "<ul>" + "".join(f"<li>{p}</li>" for p in (
+    "Какова официальная причина/формулировка в документах?",
+    "Какие даты и участники ключевых действий?",
+    "Что вы уже предпринимали и какие есть ответы/отказы?",
+    "Какие доказательства у вас на руках?",
+)) + "</ul>"
+
+# Статичные блоки проходят правила/санитайзер один раз при импорте, а не в каждом ответе
+_ANSWER_HEAD_HTML = postprocess_html(_ANSWER_HEAD)
+_DEFAULT_CLARIFY_SAFE = postprocess_html(_DEFAULT_CLARIFY_HTML)
+
+def build_html_answer(question: str, hits, intent: dict) -> str:
+    """
+    Рендерим итоговый HTML-ответ. Тут же:
+    - не вставляем <html>/<body>;
+    - даём аккуратный «шаблон/структуру» без сырого HTML;
+    - добавляем явное пояснение к «Что уточнить».
+    """
     # Если есть совпадения по базе — покажем ссылки/названия (без сырого текста закона)
     laws_block = ""
     if hits:
+        clean = _TEXT_CLEANER.clean
         items = []
         for art, score in hits:
-            t = bleach.clean(art.get("title", ""), strip=True)
-            src = bleach.clean(art.get("source", ""), strip=True)
+            t = clean(art.get("title", ""))
+            src = clean(art.get("source", ""))
             if t:
                 if src:
                     items.append(f"<li>{t} — <a href=\"{src}\" target=\"_blank\" rel=\"noopener\">источник</a></li>")
@@ -132,24 +194,14 @@ def build_html_answer(question: str, hits, intent: dict) -> str:
         if items:
             laws_block = "<h3>Нормативные основания</h3><ul>" + "".join(items) + "</ul>"
 
-    # «Что уточнить» — теперь с явным пояснением ЗАЧЕМ
-    clarify_intro = (
-        "<h3>Что уточнить</h3>"
-        "<p class=\"muted\">Для качественного разъяснения вашей ситуации ответьте, пожалуйста, на несколько вопросов:</p>"
-    )
     clarify_points = intent.get("clarify_points") or []
-    if not clarify_points:
-        # базовый набор, если модель не прислала свои
-        clarify_points = [
-            "Какова официальная причина/формулировка в документах?",
-            "Какие даты и участники ключевых действий?",
-            "Что вы уже предпринимали и какие есть ответы/отказы?",
-            "Какие доказательства у вас на руках?",
-        ]
-    clarify_html = clarify_intro + "<ul>" + "".join(f"<li>{bleach.clean(p, strip=True)}</li>" for p in clarify_points) + "</ul>"
-
-    html = intro + steps_html + template_html + laws_block + clarify_html
-    return postprocess_html(html)
+    if clarify_points:
+        clean = _TEXT_CLEANER.clean
+        clarify_html = _CLARIFY_INTRO + "<ul>" + "".join(f"<li>{clean(p)}</li>" for p in clarify_points) + "</ul>"
+        return _ANSWER_HEAD_HTML + postprocess_html(laws_block + clarify_html)
+
+    # через правила и санитайзер идёт только динамическая часть; каркас уже обработан
+    return _ANSWER_HEAD_HTML + (postprocess_html(laws_block) if laws_block else "") + _DEFAULT_CLARIFY_SAFE
 
 # =========================
 # Загрузка корпуса
@@ -159,15 +211,68 @@ _WORD_RE = re.compile(r"[a-zA-Zа-яА-ЯёЁ0-9\-]+")
 def _tok(s: str) -> List[str]:
     return _WORD_RE.findall((s or "").lower())
 
-def _read_jsonl(path: str) -> List[Dict]:
-    items = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            items.append(json.loads(line))
-    return items
+@lru_cache(maxsize=4096)
+def _query_tokens(query: str) -> Tuple[str, ...]:
+    """Токены вопроса. Мемоизировано: один вопрос идёт и в ключ кэша, и в поиск."""
+    return tuple(_tok(query))
+
+# ИИН (12 цифр), e-mail, телефон — такие вопросы не кэшируем
+_RE_PII = re.compile(
+    r"\b\d{12}\b"
+    r"|[\w.+-]+@[\w-]+\.[\w.-]+"
+    r"|(?:\+7|\b8)[\s\-(]*\d{3}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}\b"
+)
+
+def question_cache_key(question: str) -> str:
+    """
+    Ключ для кэша ответов: регистр и пунктуация не важны, порядок и повторы слов — важны
+    («5 МРП за 10 дней» и «10 МРП за 5 дней» — разные вопросы).
+    Хранится blake2b-дайджест, а не сам текст; пустая строка — не кэшировать.
+    """
+    if not question or _RE_PII.search(question):
+        return ""
+    norm = " ".join(_query_tokens(question))
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).hexdigest() if norm else ""
+
+class JsonlDocs(Sequence):
+    """
+    Read-only последовательность записей JSONL поверх mmap.
+
+    В памяти держим только смещения строк; dict декодируется (orjson) при обращении
+    к элементу. Страницы файла — общий page cache, а не куча каждого воркера.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        starts: List[int] = []
+        ends: List[int] = []
+        mm, pos = self._mm, 0
+        while pos < size:
+            end = mm.find(b"\n", pos)
+            if end == -1:
+                end = size
+            if mm[pos:end].strip():
+                starts.append(pos)
+                ends.append(end)
+            pos = end + 1
+        self._starts = np.asarray(starts, dtype=np.int64)
+        self._ends = np.asarray(ends, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, i: int) -> Dict:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return orjson.loads(self._mm[self._starts[i]:self._ends[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 def load_jsonl(path: str) -> List[Dict]:
     """
@@ -180,13 +285,14 @@ def load_jsonl(path: str) -> List[Dict]:
         Список словарей из JSONL файла
     """
     docs = []
-    with open(path, "r", encoding="utf-8") as f:
+    # бинарный режим: orjson сам декодирует UTF-8, без промежуточных str на каждую строку
+    with open(path, "rb", buffering=1 << 20) as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
             try:
-                docs.append(json.loads(line))  # строка → dict
+                docs.append(orjson.loads(line))  # строка → dict
             except Exception as e:
                 print(f"Ошибка при чтении строки JSONL: {e}")
     return docs
@@ -198,7 +304,7 @@ def load_laws_json(path: str) -> List[Dict]:
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def load_normalized_or_fallback() -> List[Dict]:
+def load_normalized_or_fallback() -> JsonlDocs:
     """Загружаем normalized.jsonl (находится в backend/laws/normalized.jsonl)."""
     start = time.time()
     # __file__ уже в backend/, поэтому строим корректный путь напрямую
@@ -207,60 +313,186 @@ def load_normalized_or_fallback() -> List[Dict]:
     if not os.path.exists(norm_path):
         raise FileNotFoundError(f"Файл normalized.jsonl не найден по пути: {norm_path}")
 
-    docs = _read_jsonl(norm_path)
-    log.info(f"✅ Загружено {len(docs)} статей из normalized.jsonl за {time.time()-start:.2f} сек")
+    docs = JsonlDocs(norm_path)
+    log.info("✅ Загружено %d статей из normalized.jsonl за %.2f сек", len(docs), time.time() - start)
     return docs
 
 # =========================
 # Индекс BM25
 # =========================
 class LawIndex:
-    def __init__(self, docs: List[Dict]):
+    """
+    BM25 (Okapi) поверх инвертированного индекса в CSR-виде:
+    токен -> строка vocab, постинги строки r — ids/weights[indptr[r]:indptr[r + 1]].
+
+    Вес постинга = idf * нормализованный tf — от запроса не зависит, поэтому
+    скор документа — просто сумма весов токенов запроса. Массивы можно сохранить
+    на диск и открыть через mmap (см. save/load): все воркеры делят одну копию
+    в page cache вместо собственного BM25 в куче.
+    """
+
+    def __init__(self, docs: Sequence[Dict],
+                 vocab: Optional[Dict[str, int]] = None,
+                 indptr: Optional[np.ndarray] = None,
+                 ids: Optional[np.ndarray] = None,
+                 weights: Optional[np.ndarray] = None):
         self.docs = docs
+        if vocab is None:
+            vocab, indptr, ids, weights = self._build(docs)
+        self.vocab = vocab
+        self.indptr = indptr
+        self.ids = ids
+        self.weights = weights
+        # одинаковые/переставленные запросы не пересчитываем
+        self._top_cached = lru_cache(maxsize=int(os.getenv("SEARCH_CACHE_SIZE", "1024")))(self._top)
+
+    @staticmethod
+    def _build(docs: Sequence[Dict]):
         corpus = []
         for d in docs:
             text = d.get("plain_summary") or d.get("plain_text") or ""
             corpus.append(_tok(text))
-        self.bm25 = BM25Okapi(corpus)
+        bm = BM25Okapi(corpus)
+
+        # Нормализованный tf-вес BM25 и idf от запроса не зависят — считаем их здесь один раз.
+        k1, b, avgdl = bm.k1, bm.b, bm.avgdl
+        postings = defaultdict(lambda: ([], []))
+        for i, freqs in enumerate(bm.doc_freqs):
+            norm = k1 * (1 - b + b * bm.doc_len[i] / avgdl)
+            for tok, tf in freqs.items():
+                p_ids, p_weights = postings[tok]
+                p_ids.append(i)
+                p_weights.append(tf * (k1 + 1) / (tf + norm))
+
+        vocab: Dict[str, int] = {}
+        indptr = [0]
+        all_ids: List[int] = []
+        all_weights: List[float] = []
+        for tok, (p_ids, p_weights) in postings.items():
+            idf = bm.idf.get(tok) or 0.0
+            vocab[tok] = len(vocab)
+            all_ids.extend(p_ids)
+            all_weights.extend(idf * w for w in p_weights)
+            indptr.append(len(all_ids))
+        return (
+            vocab,
+            np.asarray(indptr, dtype=np.int64),
+            np.asarray(all_ids, dtype=np.int32),
+            np.asarray(all_weights, dtype=np.float64),
+        )
+
+    def save(self, path: str, source_stamp: Dict) -> None:
+        """Пишем массивы в каталог path; meta.json — последним, как признак целостности."""
+        os.makedirs(path, exist_ok=True)
+        suffix = f".{os.getpid()}.tmp"
+        tokens = sorted(self.vocab, key=self.vocab.__getitem__)
+        files = {
+            "indptr.npy": self.indptr,
+            "ids.npy": self.ids,
+            "weights.npy": self.weights,
+        }
+        for name, arr in files.items():
+            tmp = os.path.join(path, name + suffix)
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(arr))
+            os.replace(tmp, os.path.join(path, name))
+        for name, obj in (("vocab.json", tokens), ("meta.json", source_stamp)):
+            tmp = os.path.join(path, name + suffix)
+            with open(tmp, "wb") as f:
+                f.write(orjson.dumps(obj))
+            os.replace(tmp, os.path.join(path, name))
+
+    @classmethod
+    def load(cls, docs: Sequence[Dict], path: str, source_stamp: Dict) -> Optional["LawIndex"]:
+        """Открываем сохранённый индекс через mmap; None, если его нет или он устарел."""
+        try:
+            with open(os.path.join(path, "meta.json"), "rb") as f:
+                if orjson.loads(f.read()) != source_stamp:
+                    return None
+            with open(os.path.join(path, "vocab.json"), "rb") as f:
+                tokens = orjson.loads(f.read())
+            arrays = [
+                np.load(os.path.join(path, name), mmap_mode="r")
+                for name in ("indptr.npy", "ids.npy", "weights.npy")
+            ]
+        except (OSError, ValueError):
+            return None
+        indptr, ids, weights = arrays
+        if len(indptr) != len(tokens) + 1 or len(ids) != len(weights) or (len(ids) and ids.max() >= len(docs)):
+            return None
+        return cls(docs, {t: r for r, t in enumerate(tokens)}, indptr, ids, weights)
+
+    def get_scores(self, q: Sequence[str]) -> np.ndarray:
+        """То же, что BM25Okapi.get_scores, но векторно и только по постингам токенов запроса."""
+        scores = np.zeros(len(self.docs), dtype=np.float64)
+        for tok in q:
+            r = self.vocab.get(tok)
+            if r is None:
+                continue
+            start, end = self.indptr[r], self.indptr[r + 1]
+            # doc_id внутри постинга уникальны, поэтому обычное fancy-index += корректно
+            scores[self.ids[start:end]] += self.weights[start:end]
+        return scores
+
+    def _top(self, q: Tuple[str, ...], top_k: int) -> Tuple[Tuple[int, float], ...]:
+        if top_k <= 0:
+            return ()
+        scores = self.get_scores(q)
+        cand = np.flatnonzero(scores > 0.0)
+        if len(cand) > top_k:
+            # порог k-го скора; равные на границе оставляем все, чтобы при равенстве
+            # (как в rank_bm25) выигрывал меньший doc_id — cand уже отсортирован по id
+            cut = scores[cand]
+            kth = np.partition(cut, len(cut) - top_k)[len(cut) - top_k]
+            cand = cand[cut >= kth]
+        cand = cand[np.argsort(-scores[cand], kind="stable")][:top_k]
+        return tuple((int(i), float(scores[i])) for i in cand)
 
     def search(self, query: str, top_k: int = 5) -> List[Tuple[Dict, float]]:
-        q = _tok(query or "")
+        query = query or ""
+        if _RE_PII.search(query):
+            # ИИН/телефон/e-mail не должны оседать в lru-кэшах воркера — ни текст, ни токены
+            q, top = tuple(_tok(query)), self._top
+        else:
+            q, top = _query_tokens(query), self._top_cached
         if not q:
             return []
-        scores = self.bm25.get_scores(q)
-        idx_scores = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)[:top_k]
-        return [(self.docs[i], float(s)) for i, s in idx_scores if s > 0.0]
+        return [(self.docs[i], s) for i, s in top(tuple(sorted(q)), top_k)]
+
+# Каталог сохранённого индекса (mmap); пустая строка в INDEX_CACHE_DIR — не кэшировать
+INDEX_CACHE_DIR = os.getenv(
+    "INDEX_CACHE_DIR", os.path.join(os.path.dirname(__file__), "laws", "normalized.index")
+)
+_INDEX_FORMAT = 1
+
+def _source_stamp(path: str) -> Dict:
+    st = os.stat(path)
+    return {"format": _INDEX_FORMAT, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
 
-def init_index() -> Tuple[List[Dict], LawIndex]:
+def init_index() -> Tuple[Sequence[Dict], LawIndex]:
     try:
         log.info("🔄 Загрузка индекса законов...")
         start_time = time.time()
         docs = load_normalized_or_fallback()
+        stamp = _source_stamp(docs.path)
+        index = LawIndex.load(docs, INDEX_CACHE_DIR, stamp) if INDEX_CACHE_DIR else None
+        if index is not None:
+            log.info("✅ Индекс открыт из %s за %.2f сек", INDEX_CACHE_DIR, time.time() - start_time)
+            return docs, index
+
         index = LawIndex(docs)
-        log.info(f"✅ Индекс загружен за {time.time()-start_time:.2f} сек")
+        log.info("✅ Индекс загружен за %.2f сек", time.time() - start_time)
+        if INDEX_CACHE_DIR:
+            try:
+                index.save(INDEX_CACHE_DIR, stamp)
+                log.info("💾 Индекс сохранён в %s", INDEX_CACHE_DIR)
+            except OSError as e:
+                log.warning("Не удалось сохранить индекс в %s: %s", INDEX_CACHE_DIR, e)
         return docs, index
     except Exception as e:
         log.exception("❌ Критическая ошибка при загрузке индекса")
         raise RuntimeError(f"Не удалось загрузить индекс: {str(e)}")
 
-# =========================
-# Детекция намерений
-# =========================
-_INTENT_PATTERNS = [
-    ("resignation", r"\b(уволить|увольня|уволиться|расторгнуть\s+труд|заявлени[ея]\s+об\s+уволн)\b"),
-    ("register_ip", r"\b(открыть\s+ип|регистрац(ия|ии)\s+ип|как\s+оформить\s+ип|индивидуальн(ый|ого)\s+предпринимател[ья])\b"),
-    ("sick_leave", r"\b(больничн(ый|ого)|лист\s+нетрудоспособности)\b"),
-    ("maternity", r"\b(декрет|по\s+уходу\s+за\s+ребенком|рожден)\b"),
-    ("vacation", r"\b(отпуск(а|ные)?|неиспользованн(ый|ые)\s+отпуск)\b"),
-]
-
-def detect_intent(question: str) -> str:
-    q = (question or "").lower()
-    for name, pat in _INTENT_PATTERNS:
-        if re.search(pat, q):
-            return name
-    return "generic"
-
 # =========================
 # Шаблоны документов
 # =========================
@@ -305,6 +537,15 @@ def template_for_intent(intent: str) -> str:
 # =========================
 # Веб-обогащение (опционально)
 # =========================
+# Общая HTTP-сессия: keep-alive и пул соединений вместо нового TCP/TLS на каждый запрос
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+_WEB_TIMEOUT = (3.05, 8)  # (connect, read)
+
+def web_enrich_enabled() -> bool:
+    """Заданы ли ключи хоть одного поискового API (иначе web_enrich_official_sources всегда вернёт [])."""
+    return bool(os.getenv("SERPAPI_KEY") or (os.getenv("GOOGLE_API_KEY") and os.getenv("GOOGLE_CSE_ID")))
+
 def web_enrich_official_sources(query: str, limit: int = 3) -> List[Dict]:
     """
     Если есть SERPAPI_KEY (или GOOGLE_API_KEY + GOOGLE_CSE_ID), подтягиваем 1–3 ссылки
@@ -316,10 +557,10 @@ def web_enrich_official_sources(query: str, limit: int = 3) -> List[Dict]:
     if serp_key:
         try:
             q = f"site:adilet.zan.kz OR site:egov.kz OR site:gov.kz {query}"
-            r = requests.get(
+            r = _HTTP.get(
                 "https://serpapi.com/search.json",
                 params={"engine": "google", "q": q, "num": limit, "hl": "ru", "gl": "kz", "api_key": serp_key},
-                timeout=8,
+                timeout=_WEB_TIMEOUT,
             )
             j = r.json()
             for it in (j.get("organic_results") or [])[:limit]:
@@ -333,10 +574,10 @@ def web_enrich_official_sources(query: str, limit: int = 3) -> List[Dict]:
     if g_key and cse_id:
         try:
             q = f"{query} site:adilet.zan.kz OR site:egov.kz OR site:gov.kz"
-            r = requests.get(
+            r = _HTTP.get(
                 "https://www.googleapis.com/customsearch/v1",
                 params={"key": g_key, "cx": cse_id, "q": q, "num": limit, "hl": "ru"},
-                timeout=8,
+                timeout=_WEB_TIMEOUT,
             )
             j = r.json()
             for it in (j.get("items") or [])[:limit]:
@@ -356,7 +597,9 @@ def _init_llm():
         log.warning("GEMINI_API_KEY не задан — LLM отключён.")
         return None
     try:
-        genai.configure(api_key=api_key)
+        # gRPC: один долгоживущий HTTP/2-канал на процесс, запросы мультиплексируются без
+        # повторного TLS-рукопожатия; "rest" оставлен на случай прокси без HTTP/2
+        genai.configure(api_key=api_key, transport=os.getenv("GEMINI_TRANSPORT", "grpc"))
     except Exception as e:
         log.warning("Gemini configure failed: %s", e)
         return None
@@ -386,13 +629,10 @@ def _init_llm():
 
 _MODEL = _init_llm()
 
-def call_llm(question: str,
-             hits: List[Tuple[Dict, float]],
-             intent: str,
-             web_sources: Optional[List[Dict]] = None) -> str:
-    if _MODEL is None:
-        return ""
-
+def _build_prompt(question: str,
+                  hits: List[Tuple[Dict, float]],
+                  intent: str,
+                  web_sources: Optional[List[Dict]] = None) -> str:
     # Компактный HTML-контекст из корпуса
     ctx_parts: List[str] = []
     for rec, _ in hits[:3]:
@@ -424,60 +664,161 @@ def call_llm(question: str,
         if items:
             source_html = "<h3>Официальные источники (для справки)</h3><ul>" + "".join(items) + "</ul>"
 
-    prompt = (
-        "<h3>Вопрос пользователя</h3>"
-        f"<p>{question}</p>"
-        "<h3>Релевантные выдержки</h3>"
-        + ("\n".join(ctx_parts) if ctx_parts else "<p>Точных совпадений не найдено.</p>")
-        + template_hint
-        + source_html
-        + "<p>Собери финальный ответ строго в ЧИСТОМ HTML без Markdown.</p>"
-    )
+    return "".join((
+        "<h3>Вопрос пользователя</h3>",
+        f"<p>{question}</p>",
+        "<h3>Релевантные выдержки</h3>",
+        "\n".join(ctx_parts) if ctx_parts else "<p>Точных совпадений не найдено.</p>",
+        template_hint,
+        source_html,
+        "<p>Собери финальный ответ строго в ЧИСТОМ HTML без Markdown.</p>",
+    ))
+
+def _llm_text_to_html(txt: str) -> str:
+    """Сырой текст модели -> безопасный HTML (экранирование, whitelist тегов, постобработка)."""
+    # На всякий случай заменим **...** → <strong>…</strong>
+    if "**" in txt:
+        txt = _RE_MD_BOLD.sub(r"<strong>\1</strong>", txt)
+    # Корректное экранирование HTML и обработка переносов строк
+    txt = html.escape(txt)
+    # Восстанавливаем разрешённые теги после экранирования — одним проходом по тексту
+    txt = _RE_ESCAPED_TAG.sub(r"<\1>", txt)
+    # Заменяем переносы строк на <br> только для обычного текста
+    if "\n" in txt:
+        txt = _RE_BARE_NL.sub('<br>', txt)
+    return postprocess_html(txt)
+
+# Повторяем только транзиентные 500/503 провайдера, с джиттером (без синхронных волн повторов);
+# 429 и таймауты не повторяем — это лишь усилит перегрузку. Затяжной сбой — дело автомата в app.py
+@retry(
+    retry=retry_if_exception_type((gexc.ServiceUnavailable, gexc.InternalServerError)),
+    wait=wait_random_exponential(min=0.2, max=2),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+def _generate(prompt: str, deadline: Optional[float] = None):
+    # дедлайн общий на все попытки: SDK обрывает gRPC-вызов, поток executor'а не висит дольше
+    request_options = None
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise gexc.DeadlineExceeded("LLM deadline exhausted before retry")
+        request_options = {"timeout": remaining}
+    return _MODEL.generate_content(prompt, request_options=request_options)
 
+def call_llm(question: str,
+             hits: List[Tuple[Dict, float]],
+             intent: str,
+             web_sources: Optional[List[Dict]] = None,
+             timeout: Optional[float] = None) -> str:
+    if _MODEL is None:
+        return ""
+
+    prompt = _build_prompt(question, hits, intent, web_sources)
     try:
-        r = _MODEL.generate_content(prompt)
-        txt = (r.text or "").strip()
-        # На всякий случай заменим **...** → <strong>…</strong>
-        txt = re.sub(r"\*\*(.+?)\*\*", r"<strong>\1</strong>", txt)
-        # Корректное экранирование HTML и обработка переносов строк
-        txt = html.escape(txt)
-        txt = txt.replace("&lt;br&gt;", "<br>")  # Восстанавливаем <br> после экранирования
-        txt = txt.replace("&lt;/p&gt;", "</p>")  # Восстанавливаем </p> после экранирования
-        txt = txt.replace("&lt;p&gt;", "<p>")    # Восстанавливаем <p> после экранирования
-        txt = txt.replace("&lt;strong&gt;", "<strong>")  # Восстанавливаем <strong> после экранирования
-        txt = txt.replace("&lt;/strong&gt;", "</strong>")  # Восстанавливаем </strong> после экранирования
-        txt = txt.replace("&lt;ul&gt;", "<ul>")  # Восстанавливаем <ul> после экранирования
-        txt = txt.replace("&lt;/ul&gt;", "</ul>")  # Восстанавливаем </ul> после экранирования
-        txt = txt.replace("&lt;li&gt;", "<li>")  # Восстанавливаем <li> после экранирования
-        txt = txt.replace("&lt;/li&gt;", "</li>")  # Восстанавливаем </li> после экранирования
-        txt = txt.replace("&lt;h3&gt;", "<h3>")  # Восстанавливаем <h3> после экранирования
-        txt = txt.replace("&lt;/h3&gt;", "</h3>")  # Восстанавливаем </h3> после экранирования
-        txt = txt.replace("&lt;pre&gt;", "<pre>")  # Восстанавливаем <pre> после экранирования
-        txt = txt.replace("&lt;/pre&gt;", "</pre>")  # Восстанавливаем </pre> после экранирования
-        txt = txt.replace("&lt;a&gt;", "<a>")  # Восстанавливаем <a> после экранирования
-        txt = txt.replace("&lt;/a&gt;", "</a>")  # Восстанавливаем </a> после экранирования
-        txt = txt.replace("&lt;em&gt;", "<em>")  # Восстанавливаем <em> после экранирования
-        txt = txt.replace("&lt;/em&gt;", "</em>")  # Восстанавливаем </em> после экранирования
-        txt = txt.replace("&lt;ol&gt;", "<ol>")  # Восстанавливаем <ol> после экранирования
-        txt = txt.replace("&lt;/ol&gt;", "</ol>")  # Восстанавливаем </ol> после экранирования
-        txt = txt.replace("&lt;blockquote&gt;", "<blockquote>")  # Восстанавливаем <blockquote> после экранирования
-        txt = txt.replace("&lt;/blockquote&gt;", "</blockquote>")  # Восстанавливаем </blockquote> после экранирования
-        txt = txt.replace("&lt;code&gt;", "<code>")  # Восстанавливаем <code> после экранирования
-        txt = txt.replace("&lt;/code&gt;", "</code>")  # Восстанавливаем </code> после экранирования
-        txt = txt.replace("&lt;hr&gt;", "<hr>")  # Восстанавливаем <hr> после экранирования
-        txt = txt.replace("&lt;span&gt;", "<span>")  # Восстанавливаем <span> после экранирования
-        txt = txt.replace("&lt;/span&gt;", "</span>")  # Восстанавливаем </span> после экранирования
-        txt = txt.replace("&lt;small&gt;", "<small>")  # Восстанавливаем <small> после экранирования
-        txt = txt.replace("&lt;/small&gt;", "</small>")  # Восстанавливаем </small> после экранирования
-        txt = txt.replace("&lt;h4&gt;", "<h4>")  # Восстанавливаем <h4> после экранирования
-        txt = txt.replace("&lt;/h4&gt;", "</h4>")  # Восстанавливаем </h4> после экранирования
-        # Заменяем переносы строк на <br> только для обычного текста
-        txt = re.sub(r'(?<!&lt;)(?<!<)(?<!>)\n(?!&gt;)(?!>)', '<br>', txt)
-        return postprocess_html(txt)
+        r = _generate(prompt, time.time() + timeout if timeout else None)
+        return _llm_text_to_html((r.text or "").strip())
+    except gexc.DeadlineExceeded as e:
+        log.warning("⏳ LLM deadline (%ss): %s", timeout, e)
+        return ""
     except Exception as e:
         log.exception("LLM error: %s", e)
         return ""
-    
+
+# Стрим режем только по законченным блокам верхнего уровня: закрывающий блочный тег
+# или пустая строка вне открытых <p>/<ul>/<ol>/<pre>/<blockquote>/<h3>/<h4>
+_RE_STREAM_CUT = re.compile(r"\n\n|<(/?)(p|ul|ol|pre|blockquote|h3|h4)\b[^>]*>", re.I)
+_RE_LEADING_WS = re.compile(r"\s*")
+
+def _stream_cut(text: str) -> int:
+    """
+    Длина префикса text из законченных блоков вместе с пробелами за ними (0 — резать пока нельзя).
+
+    Пробелы после блока уходят с ним же, поэтому режем только перед непробельным символом:
+    иначе перевод строки стал бы началом следующего блока и превратился там в <br>.
+    """
+    depth = 0
+    cut = 0
+    for m in _RE_STREAM_CUT.finditer(text):
+        if m.group(2) is not None:
+            if not m.group(1):
+                depth += 1
+                continue
+            depth = max(0, depth - 1)
+        if depth == 0:
+            end = _RE_LEADING_WS.match(text, m.end()).end()
+            if end < len(text):
+                cut = end
+    return cut
+
+def _stream_block_html(block: str, nxt: str = "") -> str:
+    """
+    HTML одного блока стрима; nxt — первый символ следующего блока.
+
+    Блок без хвостовых пробелов идёт через _llm_text_to_html, а сами пробелы — через
+    те же _RE_BARE_NL/_RE_BR_RUN с соседями по краям, как в целом тексте: склейка
+    дельт совпадает с call_llm на том же тексте.
+    """
+    core = block.rstrip()
+    gap = block[len(core):]
+    out = _llm_text_to_html(core)
+    if "\n" in gap:
+        before = out[-4:]
+        after = "&gt;" if nxt == ">" else ""
+        gap = _RE_BARE_NL.sub("<br>", before + gap + after)
+        gap = gap[len(before):len(gap) - len(after)]
+        if "<br" in gap:
+            gap = _RE_BR_RUN.sub("<br>", gap)
+    return out + gap
+
+def call_llm_stream(question: str,
+                    hits: List[Tuple[Dict, float]],
+                    intent: str,
+                    web_sources: Optional[List[Dict]] = None,
+                    timeout: Optional[float] = None) -> Generator[str, None, str]:
+    """
+    Стримит ответ Gemini по мере генерации.
+
+    Отдаёт HTML-дельты: как только в буфере набирается законченный блок верхнего
+    уровня, он один раз проходит обработку и уходит наружу; незаконченный хвост ждёт
+    следующих чанков. Возвращает (StopIteration.value) HTML всего ответа — один проход
+    _llm_text_to_html по полному тексту, ровно как call_llm. Ошибки провайдера, в том
+    числе посреди стрима, не глотаются: оборванный ответ не должен сойти за полный.
+    """
+    if _MODEL is None:
+        return ""
+
+    prompt = _build_prompt(question, hits, intent, web_sources)
+    request_options = {"timeout": timeout} if timeout else None
+    raw: List[str] = []
+    pending = ""
+    started = False
+    for chunk in _MODEL.generate_content(prompt, stream=True, request_options=request_options):
+        try:
+            piece = chunk.text
+        except ValueError:
+            # чанк без текстовой части (например, только finish_reason)
+            continue
+        if not piece:
+            continue
+        raw.append(piece)
+        pending += piece
+        if not started:
+            # call_llm режет пробелы в начале ответа — и мы тоже
+            pending = pending.lstrip()
+        cut = _stream_cut(pending)
+        if cut:
+            block = _stream_block_html(pending[:cut], pending[cut])
+            pending = pending[cut:]
+            started = True
+            if block:
+                yield block
+    if pending.strip():
+        block = _llm_text_to_html(pending)
+        if block:
+            yield block
+    return _llm_text_to_html("".join(raw).strip())
+
 # =========================
 # Поиск
 # =========================
@@ -486,16 +827,18 @@ def search_laws(question: str, docs: List[Dict], index: LawIndex, top_k: int = 5
     intent = detect_intent(question)
     return hits, intent
 
+# Стемы ключевых слов по намерениям (подстрочный поиск); собираем один раз при импорте
+_INTENT_KEYWORDS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("labor", ("увольн", "работ", "труд", "зарплат", "отпуск")),  # Labor-related
+    ("rent", ("аренд", "жиль", "квартир", "найм")),  # Rent-related
+    ("crime", ("убийств", "краж", "преступлен", "убили")),  # Crime-related
+    # Add more intents and keywords as needed
+)
+
 def detect_intent(question: str) -> dict:
     """Simple intent detection based on keywords. Returns a dict for consistency."""
     question = question.lower()
-    intents = {
-        "labor": ["увольн", "работ", "труд", "зарплат", "отпуск"],  # Labor-related
-        "rent": ["аренд", "жиль", "квартир", "найм"],  # Rent-related
-        "crime": ["убийств", "краж", "преступлен", "убили"],  # Crime-related
-        # Add more intents and keywords as needed
-    }
-    for intent_type, keywords in intents.items():
+    for intent_type, keywords in _INTENT_KEYWORDS:
         if any(keyword in question for keyword in keywords):
             return {"type": intent_type, "clarify_points": []}  # Can add specific clarify_points per type later
     return {"type": "generic", "clarify_points": []}
@@ -0,0 +1,83 @@
+# test_stream.py — склейка дельт /api/ask/stream совпадает с ответом call_llm
+# Запуск: python -m unittest test_stream (из каталога backend)
+import random
+import unittest
+
+import helpers
+
+TEXTS = (
+    "<h3>Оценка</h3>\n<p>Ответ **жирный**</p>\n<ul><li>a</li>\n<li>b</li></ul>\n\n"
+    "Просто текст\nвторая строка\n\n<pre>код\n  x</pre>\n<p>конец</p>\n",
+    "  \n<h3>Оценка</h3>\n\n\n\n<p>Часть 1</p><script>x</script>\n<ul><li>шаг</li></ul>",
+    "abc\n\ndef\n\n\nghi",
+    "<p>a > b</p>\n> цитата\n\n<h4>x</h4>\n\n<blockquote>q\n\nw</blockquote>\n<p>Обратитесь к юристу</p>",
+)
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+class _Reply:
+    def __init__(self, text):
+        self.text = text
+
+class _FakeModel:
+    """Отдаёт один и тот же текст целиком или случайными кусками."""
+
+    def __init__(self, text, seed):
+        self._text = text
+        self._rnd = random.Random(seed)
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        if not stream:
+            return _Reply(self._text)
+        pieces, i = [], 0
+        while i < len(self._text):
+            n = self._rnd.randint(1, 40)
+            pieces.append(_Chunk(self._text[i:i + n]))
+            i += n
+        return iter(pieces)
+
+def _drain(gen):
+    """(дельты, возвращённый генератором HTML всего ответа)"""
+    parts = []
+    while True:
+        try:
+            parts.append(next(gen))
+        except StopIteration as stop:
+            return parts, stop.value
+
+class StreamMatchesCallLlm(unittest.TestCase):
+    def setUp(self):
+        self._model = helpers._MODEL
+
+    def tearDown(self):
+        helpers._MODEL = self._model
+
+    def test_joined_deltas_equal_call_llm(self):
+        for text in TEXTS:
+            for seed in range(50):
+                helpers._MODEL = _FakeModel(text, seed)
+                expected = helpers.call_llm("q", [], "generic")
+                parts, final = _drain(helpers.call_llm_stream("q", [], "generic"))
+                with self.subTest(text=text[:20], seed=seed):
+                    self.assertEqual("".join(parts), expected)
+                    self.assertEqual(final, expected)
+
+    def test_no_br_between_blocks(self):
+        helpers._MODEL = _FakeModel("<h3>Оценка</h3>\n<p>Текст</p>\n<ul><li>шаг</li></ul>", 0)
+        parts, _ = _drain(helpers.call_llm_stream("q", [], "generic"))
+        self.assertNotIn("<br>", "".join(parts))
+
+    def test_provider_error_propagates(self):
+        class _Broken(_FakeModel):
+            def generate_content(self, prompt, stream=False, request_options=None):
+                yield _Chunk("<p>начало</p>\n<p>")
+                raise helpers.gexc.DeadlineExceeded("mid-stream")
+
+        helpers._MODEL = _Broken("", 0)
+        with self.assertRaises(helpers.gexc.DeadlineExceeded):
+            _drain(helpers.call_llm_stream("q", [], "generic"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -206,6 +206,77 @@ document.addEventListener('DOMContentLoaded', () => {
        await apiFetch("/health");
     */
 
+    /* =========   STREAM (SSE поверх fetch)   ========= */
+    /* Кадры без event: {"delta": ...} — очередной законченный блок HTML (уже санитизирован),
+       дописывается в конец; event: done — финальное тело как у /ask, event: error — ошибка на сервере. */
+    async function askStream(question, onDelta) {
+      let res;
+      try {
+        res = await fetch(`${API_BASE}/ask/stream`, {
+          method: "POST",
+          credentials: "same-origin",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ question }),
+        });
+      } catch (e) {
+        e.fallback = true; // сетевая ошибка — /ask ещё может пройти
+        throw e;
+      }
+      const ct = res.headers.get("content-type") || "";
+      const isStream = res.ok && res.body && ct.includes("text/event-stream");
+      if (!isStream) {
+        // стрим-роута нет (404/405) или ответ не SSE (старый бэкенд, прокси) — вызывающий уйдёт на /ask
+        if (res.status === 404 || res.status === 405 || res.ok) {
+          const err = new Error(`HTTP ${res.status}: stream unavailable`);
+          err.fallback = true;
+          throw err;
+        }
+        // 400/413/503…: /ask ответит тем же — отдаём тело ошибки как есть
+        return res.json().catch(() => ({ ok: false, error: { message: `HTTP ${res.status}` } }));
+      }
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buf = "";
+      let result = null;
+      while (true) {
+        let chunk;
+        try {
+          chunk = await reader.read();
+        } catch (e) {
+          e.fallback = true; // соединение оборвалось — тоже сетевая ошибка
+          throw e;
+        }
+        const { done, value } = chunk;
+        if (done) break;
+        buf += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buf.indexOf("\n\n")) !== -1) {
+          const frame = buf.slice(0, sep);
+          buf = buf.slice(sep + 2);
+          let event = "message";
+          let data = "";
+          for (const line of frame.split("\n")) {
+            if (line.startsWith("event:")) event = line.slice(6).trim();
+            else if (line.startsWith("data:")) data += line.slice(5).trim();
+          }
+          if (!data) continue;
+          const payload = JSON.parse(data);
+          if (event === "done" || event === "error") {
+            result = payload;
+          } else if (payload.delta) {
+            onDelta(payload.delta);
+          }
+        }
+      }
+      if (!result) {
+        const err = new Error("stream ended without result");
+        err.fallback = true;
+        throw err;
+      }
+      return result;
+    }
+
     // Проверка готовности сервера
     async function checkServerReady() {
         try {
@@ -259,6 +330,12 @@ document.addEventListener('DOMContentLoaded', () => {
         chatHistory.scrollTop = chatHistory.scrollHeight;
     }
 
+    // Дописать блок в конец, не перепарсивая уже показанный HTML
+    function appendBotMessage(messageDiv, html) {
+        messageDiv.insertAdjacentHTML('beforeend', html);
+        chatHistory.scrollTop = chatHistory.scrollHeight;
+    }
+
     async function sendMessage(message = null) {
         const messageText = message || userInput.value.trim();
         if (messageText === '') return;
@@ -309,12 +386,28 @@ document.addEventListener('DOMContentLoaded', () => {
             }
 
             console.log('Sending payload:', { question: messageText.trim() });
-            const res = await apiFetch("/ask", { 
-                method: "POST", 
-                body: { question: messageText.trim() } 
-            });
-            
-            const data = await res.json();
+            // Сначала стрим: текст появляется по мере генерации. Если стрим недоступен
+            // и ничего не успели показать — обычный /ask.
+            let botMessage = null;
+            let data = null;
+            try {
+                data = await askStream(messageText.trim(), (delta) => {
+                    if (!botMessage) {
+                        hideLoading();
+                        botMessage = addMessage('bot', delta);
+                    } else {
+                        appendBotMessage(botMessage, delta);
+                    }
+                });
+            } catch (streamError) {
+                if (botMessage || !streamError.fallback) throw streamError;
+                console.warn('[sendMessage] Stream failed, falling back to /ask:', streamError.message);
+                const res = await apiFetch("/ask", { 
+                    method: "POST", 
+                    body: { question: messageText.trim() } 
+                });
+                data = await res.json();
+            }
             
             if (!data?.ok) {
                 console.error('[sendMessage] Logical error:', data);
@@ -328,7 +421,11 @@ document.addEventListener('DOMContentLoaded', () => {
             }
 
             // У вас рендер HTML
-            addMessage('bot', data.answer_html);
+            if (botMessage) {
+                updateBotMessage(botMessage, data.answer_html);
+            } else {
+                addMessage('bot', data.answer_html);
+            }
         } catch (error) {
             console.error('[sendMessage] Error:', error);
             addMessage('bot', `
@@ -21,7 +21,7 @@ import json
 import hashlib
 import datetime as dt
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 from urllib.parse import urljoin, urlparse
 
 import requests
@@ -96,12 +96,15 @@ def save_json_list(p: Path, items: List[Dict]):
         json.dump(items, f, ensure_ascii=False, indent=2)
 
 # ---- скачивание и извлечение текста ----
+# одна сессия на весь прогон: статьи тянутся сотнями с одного хоста, keep-alive экономит TLS-рукопожатия
+HTTP = requests.Session()
+
 def fetch_url(url: str, timeout=40) -> Optional[str]:
     try:
         headers = {
             "User-Agent": "Mozilla/5.0 (KazLegalBot Update Script; +https://github.com/your-repo)"
         }
-        resp = requests.get(url, headers=headers, timeout=timeout)
+        resp = HTTP.get(url, headers=headers, timeout=timeout)
         resp.raise_for_status()
         content = resp.content
         # корректная декодировка
@@ -122,7 +125,7 @@ def fetch_egov_laws() -> List[Dict]:
         })
     }
     
-    response = requests.get(url, params=params, timeout=15)
+    response = HTTP.get(url, params=params, timeout=15)
     response.raise_for_status()  # Проверка на ошибки HTTP
     data = response.json()
     
@@ -170,12 +173,16 @@ def extract_main_text(html: str) -> str:
     text = cand.get_text(separator="\n", strip=True)
     return text
 
-def extract_article_links_from_toc(html: str, base_url: str) -> list[dict]:
+def make_soup(page: Union[str, BeautifulSoup]) -> BeautifulSoup:
+    """Разбирает HTML (lxml); уже готовый soup возвращает как есть, чтобы не парсить страницу повторно."""
+    return page if isinstance(page, BeautifulSoup) else BeautifulSoup(page, "lxml")
+
+def extract_article_links_from_toc(html: Union[str, BeautifulSoup], base_url: str) -> list[dict]:
     """
     Находит в странице ссылки на статьи (оглавление).
     Возвращает список dict: {"article_title": "...", "href": "полный_URL", "anchor": "...", "is_same_page": True/False}
     """
-    soup = BeautifulSoup(html, "lxml")
+    soup = make_soup(html)
     links = []
     # 1) быстро искать явные <a> с текстом 'Статья'
     for a in soup.find_all('a', href=True):
@@ -201,13 +208,14 @@ def extract_article_links_from_toc(html: str, base_url: str) -> list[dict]:
                 links.append({"article_title": txt, "href": full, "is_same_page": urlparse(full).path == urlparse(base_url).path, "raw_href": href})
     return links
 
-def extract_article_text_by_anchor_or_header(page_html: str, locator_href: str, base_url: str) -> str:
+def extract_article_text_by_anchor_or_header(page_html: Union[str, BeautifulSoup], locator_href: str, base_url: str) -> str:
     """
     Если locator_href — это '...#anchor' (или просто '#anchor'), найдём соответствующий элемент по id/name
     и соберём текст до следующего заголовка того же/высшего уровня. Если locator_href — full URL,
     будем возвращать весь текст страницы (или применять heuristics).
+    Можно передать готовый soup — так одна страница со многими якорями парсится один раз.
     """
-    soup = BeautifulSoup(page_html, "lxml")
+    soup = make_soup(page_html)
     parsed = urlparse(locator_href)
     anchor = parsed.fragment or None
 
@@ -409,7 +417,9 @@ def main():
             continue
 
         # 1) сначала пытаемся найти оглавление/ссылки на статьи
-        article_links = extract_article_links_from_toc(html, url)
+        # страницу разбираем один раз: по ней же ищутся все якоря статей
+        soup = make_soup(html)
+        article_links = extract_article_links_from_toc(soup, url)
 
         if article_links:
             print(f"[INFO] Найдено {len(article_links)} статей в {title}")
@@ -421,7 +431,7 @@ def main():
 
                 if is_same or (urlparse(href).netloc == urlparse(url).netloc and urlparse(href).path == urlparse(url).path):
                     # якорь на той же странице — используем исходный html
-                    art_text = extract_article_text_by_anchor_or_header(html, link_info['raw_href'], url)
+                    art_text = extract_article_text_by_anchor_or_header(soup, link_info['raw_href'], url)
                 else:
                     # отдельная страница — скачиваем
                     sub_html = fetch_url(href)